@@ -1,102 +1,349 @@
 
+import itertools
+import math
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
+from joblib import Parallel, delayed
+
+from scipy.optimize import minimize
+from scipy.signal import lfilter
+
 from statsmodels.tsa.arima.model import ARIMA
 
+from sklearn.base import clone
 from sklearn.metrics import mean_squared_error, accuracy_score
 from sklearn.linear_model import LinearRegression, LassoLars, TweedieRegressor
-from sklearn.preprocessing import PolynomialFeatures, StandardScaler
+from sklearn.preprocessing import PolynomialFeatures
 from sklearn.feature_selection import RFE
 
-def evaluate_arima_model(train, test, target, arima_order):
-    """ Evaluates an ARIMA model based on arima_order argument, train set, test set, and target. 
+def _arima_css_residuals(params, y_diff, p, q, include_constant):
+    """ Returns the conditional residuals of an ARMA(p, q) model on the (already differenced) series y_diff.
+    params are [mean (if include_constant), ar coefficients, ma coefficients]"""
+    mean = params[0] if include_constant else 0.0
+    ar = params[int(include_constant) : int(include_constant) + p]
+    ma = params[int(include_constant) + p :]
+    # e_t = x_t - sum(ar_i * x_t-i) - sum(ma_j * e_t-j), run as a linear filter so the recursion is in compiled code
+    return lfilter(np.r_[1.0, -ar], np.r_[1.0, ma], y_diff - mean)
+
+def fit_arima_css(y, arima_order):
+    """ Fits an ARIMA model to y by minimizing the conditional sum of squares (CSS) with Nelder-Mead.
+    A constant (mean) is only included when d = 0, as in statsmodels' ARIMA. Returns the fitted parameters.
+    Raises ValueError if the optimizer did not converge or the fit is not stationary and invertible"""
+    p, d, q = arima_order
+    y_diff = np.diff(np.asarray(y, dtype=np.float64), n=d)
+    include_constant = d == 0
+
+    # Start from a white noise model around the sample mean
+    start_params = np.zeros(int(include_constant) + p + q)
+    if include_constant:
+        start_params[0] = y_diff.mean()
+    if len(start_params) == 0:
+        return start_params
+
+    # The first p residuals depend on values before the start of the series so are left out of the sum of squares
+    css = lambda params: np.sum(_arima_css_residuals(params, y_diff, p, q, include_constant)[p:]**2)
+    result = minimize(css, start_params, method='Nelder-Mead')
+    if not result.success:
+        raise ValueError(f"CSS fit of {arima_order} did not converge: {result.message}")
+
+    # The inverse roots of the AR and MA polynomials must lie inside the unit circle
+    ar = result.x[int(include_constant) : int(include_constant) + p]
+    ma = result.x[int(include_constant) + p :]
+    if np.any(np.abs(np.roots(np.r_[1.0, -ar])) >= 1):
+        raise ValueError(f"CSS fit of {arima_order} is not stationary")
+    if np.any(np.abs(np.roots(np.r_[1.0, ma])) >= 1):
+        raise ValueError(f"CSS fit of {arima_order} is not invertible")
+    return result.x
+
+def forecast_arima_css(params, y, arima_order):
+    """ Returns the one step ahead forecast of y from an ARIMA model with parameters fit by fit_arima_css"""
+    p, d, q = arima_order
+    y = np.asarray(y, dtype=np.float64)
+    y_diff = np.diff(y, n=d)
+    include_constant = d == 0
+    mean = params[0] if include_constant else 0.0
+    ar = params[int(include_constant) : int(include_constant) + p]
+    ma = params[int(include_constant) + p :]
+
+    # Forecast the differenced series from its last p values and last q residuals
+    residuals = _arima_css_residuals(params, y_diff, p, q, include_constant)
+    x = y_diff - mean
+    diff_forecast = mean + np.dot(ar, x[::-1][:p]) + np.dot(ma, residuals[::-1][:q])
+
+    # Undo the differencing: y_t+1 = diff_forecast - sum over k of C(d, k) * (-1)^k * y_t+1-k
+    return diff_forecast - sum(math.comb(d, k) * (-1)**k * y[-k] for k in range(1, d + 1))
+
+def evaluate_arima_model_css(train, test, target, arima_order, refit_every=0):
+    """ Evaluates an ARIMA model fit by conditional sum of squares, based on arima_order argument, train set, test set, and target.
+    Parameters are fit once on train and reused for every step in test (re-estimated every refit_every steps if refit_every > 0).
     Outputs error, actual test values, and predictions for every timestep in test"""
     # Set the target as a series
     train_target = train[target]
     test_target = test[target]
-    history = [x for x in train_target]
+    # Preallocate history for train and test values, only history[:end] is filled so far
+    n_train, n_test = len(train_target), len(test_target)
+    history = np.empty(n_train + n_test, dtype=np.float64)
+    history[:n_train] = np.asarray(train_target)
+    end = n_train
+
+    # Fit once on train, parameters are reused for every step in test
+    params = fit_arima_css(history[:end], arima_order)
 
     # Make predictions
     predictions = []
     for t in range(len(test_target)):
-        print(f"\tTesting {arima_order} {t}/{len(test_target)}", end="\r")
-        model = ARIMA(history, order = arima_order)
-        model_fit = model.fit()
-        # Forecast returns forecast value, standard error, and confidence interval - only need forecast value ([0])
+        # Only print progress every 50 steps to keep terminal output from slowing down the loop
+        if t % 50 == 0:
+            print(f"\tTesting {arima_order} {t}/{n_test}", end="\r")
+        yhat = forecast_arima_css(params, history[:end], arima_order)
+        predictions.append(yhat)
+        # Adds the latest test value to history so it can be used to train
+        history[end] = test_target.iloc[t]
+        end += 1
+        if refit_every > 0 and (t + 1) % refit_every == 0:
+            # Periodically re-estimate parameters on the full history to avoid parameter drift
+            params = fit_arima_css(history[:end], arima_order)
+    error = mean_squared_error(test_target, predictions)
+    print("\n")
+    return error, test_target, predictions
+
+def evaluate_arima_model(train, test, target, arima_order, refit_every=0, method='mle'):
+    """ Evaluates an ARIMA model based on arima_order argument, train set, test set, and target.
+    The model is fit once on train and its state is updated with each new test value (parameters are re-estimated
+    every refit_every steps if refit_every > 0).
+    By default statsmodels' ARIMA (exact MLE) is used. With method='css', small orders (p+d+q <= 6) are instead fit
+    with the faster but approximate conditional sum of squares estimator in evaluate_arima_model_css, falling back to
+    MLE if the CSS fit does not converge or is not stationary and invertible.
+    Outputs error, actual test values, and predictions for every timestep in test"""
+    if method == 'css' and sum(arima_order) <= 6:
+        try:
+            return evaluate_arima_model_css(train, test, target, arima_order, refit_every)
+        except ValueError as e:
+            print(f"{e}, falling back to MLE")
+
+    # Set the target as a series
+    train_target = train[target]
+    test_target = test[target]
+    # Preallocate history for train and test values, only history[:end] is filled so far
+    n_train, n_test = len(train_target), len(test_target)
+    history = np.empty(n_train + n_test, dtype=np.float64)
+    history[:n_train] = np.asarray(train_target)
+    end = n_train
+
+    # Fit once on train, parameters are reused for every step in test
+    model_fit = ARIMA(history[:end], order = arima_order).fit()
+
+    # Make predictions
+    predictions = []
+    for t in range(len(test_target)):
+        # Only print progress every 50 steps to keep terminal output from slowing down the loop
+        if t % 50 == 0:
+            print(f"\tTesting {arima_order} {t}/{n_test}", end="\r")
+        # Forecast returns an array of forecast values - only need the next one ([0])
         yhat = model_fit.forecast()[0]
         predictions.append(yhat)
         # Adds the latest test value to history so it can be used to train
-        history.append(test_target[t])
+        history[end] = test_target.iloc[t]
+        end += 1
+        if refit_every > 0 and (t + 1) % refit_every == 0:
+            # Periodically re-estimate parameters on the full history to avoid parameter drift
+            model_fit = model_fit.apply(history[:end], refit=True)
+        else:
+            # Only update the Kalman filter state with the new observation, keeping fitted parameters
+            model_fit = model_fit.append(history[end - 1 : end])
     error = mean_squared_error(test_target, predictions)
     print("\n")
     return error, test_target, predictions
 
-def evaluate_models(train, test, target, p_values, d_values, q_values):
-    """ Evaluates an ARIMA model per the inputted p, d, and q values. Returns a pandas dataframe with the results from the model"""
+def _safe_evaluate_arima_model(train, test, target, order, method='mle'):
+    """ Runs evaluate_arima_model for a single order. Returns (None, None, None) if the order could not be fit"""
+    try:
+        return evaluate_arima_model(train, test, target, order, method=method)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt")
+        raise
+    except:
+        print(f"{order} didn't work, continuing with next order")
+        return None, None, None
+
+def evaluate_models(train, test, target, p_values, d_values, q_values, method='mle'):
+    """ Evaluates an ARIMA model per the inputted p, d, and q values. method is passed to evaluate_arima_model ('mle' or
+    the faster, approximate 'css'). Returns a pandas dataframe with the results from the model"""
+    all_orders = list(itertools.product(p_values, d_values, q_values))
+
+    # Each order is independent so fit them in parallel, unless there are too few to be worth the worker startup
+    if len(all_orders) < 4:
+        results = [_safe_evaluate_arima_model(train, test, target, order, method) for order in all_orders]
+    else:
+        results = Parallel(n_jobs=-1, backend="loky")(delayed(_safe_evaluate_arima_model)(train, test, target, order, method) for order in all_orders)
+
     mses=[]
     prediction_list=[]
     actual_test = []
     orders = []
-    for p in p_values:
-        for d in d_values:
-            for q in q_values:
-                order = (p,d,q)
-                orders.append(order)
-                try:
-                    mse, test_target, predictions = evaluate_arima_model(train, test, target, order)
-                    mses.append(mse)
-                    prediction_list.append(predictions)
-                    actual_test.append(test_target)
-                except KeyboardInterrupt:
-                    print("Keyboard interrupt")
-                    raise
-                except:
-                    print(f"{order} didn't work, continuing with next order")
-                    continue
+    # Keep only the orders that were fit successfully, in grid order
+    for order, (mse, test_target, predictions) in zip(all_orders, results):
+        if mse is None:
+            continue
+        orders.append(order)
+        mses.append(mse)
+        prediction_list.append(predictions)
+        actual_test.append(test_target)
     results_df = pd.DataFrame.from_records(orders, columns = ['p','d','q'])
     results_df["mse"] = mses
     results_df["test_predictions"] = prediction_list
     results_df["test_actual"] = actual_test
     return results_df
 
-def scale_datasets(train, validate, test, target, features_to_use, features_to_scale):
-    """Returns split dataframes with scaled features (and those features that did not need scaling)"""
+def get_arima_aic(train_target, order):
+    """ Returns the AIC of an ARIMA model fit to train_target using the fast Hannan-Rissanen (least squares) estimator.
+    Stationarity and invertibility are not enforced as this is only a screening fit. Returns infinity if the order could not be fit"""
+    try:
+        return ARIMA(train_target, order = order, enforce_stationarity=False, enforce_invertibility=False).fit(method='hannan_rissanen').aic
+    except KeyboardInterrupt:
+        raise
+    except:
+        print(f"{order} didn't work, continuing with next order")
+        return np.inf
+
+def evaluate_models_stepwise(train, test, target, max_p, max_d, max_q):
+    """ Stepwise (Hyndman-Khandakar) search for the ARIMA order with the lowest AIC on train, for each d up to max_d.
+    Candidates are fit with the fast Hannan-Rissanen estimator and only the best order for each d is evaluated on test.
+    Returns a pandas dataframe with the same columns as evaluate_models"""
+    train_target = np.asarray(train[target])
+    best_orders = []
+
+    for d in range(max_d + 1):
+        # AIC of every order fit so far for this d
+        aics = {}
+        # Initial candidates, as in auto_arima
+        candidates = [(2,d,2),(0,d,0),(1,d,0),(0,d,1)]
+        candidates = [(min(p, max_p), d, min(q, max_q)) for p, d, q in candidates]
+        best_order = None
+
+        while candidates:
+            for order in candidates:
+                if order not in aics:
+                    aics[order] = get_arima_aic(train_target, order)
+
+            current_best = min(aics, key=aics.get)
+            # Stop once no candidate improves on the current best
+            if current_best == best_order:
+                break
+            best_order = current_best
+
+            # Neighbors are +/- 1 in p and q that have not been fit yet
+            p, _, q = best_order
+            candidates = [(p+dp, d, q+dq) for dp in [-1,0,1] for dq in [-1,0,1]
+                          if 0 <= p+dp <= max_p and 0 <= q+dq <= max_q and (p+dp, d, q+dq) not in aics]
+
+        print(f"Best order for d={d}: {best_order}, AIC {aics[best_order]}, {len(aics)} orders fit")
+        best_orders.append(best_order)
+
+    # Full MLE walk forward evaluation of only the winning orders
+    mses=[]
+    prediction_list=[]
+    actual_test = []
+    orders = []
+    for order in best_orders:
+        mse, test_target, predictions = _safe_evaluate_arima_model(train, test, target, order, method='mle')
+        if mse is None:
+            continue
+        orders.append(order)
+        mses.append(mse)
+        prediction_list.append(predictions)
+        actual_test.append(test_target)
+    results_df = pd.DataFrame.from_records(orders, columns = ['p','d','q'])
+    results_df["mse"] = mses
+    results_df["test_predictions"] = prediction_list
+    results_df["test_actual"] = actual_test
+    return results_df
+
+class FastStandardScaler:
+    """ Standardizes dense float arrays to zero mean and unit variance. Equivalent to sklearn's StandardScaler for
+    this use case but without its input validation and sparse handling overhead"""
+
+    def fit(self, X):
+        """ Stores the mean and standard deviation of each column of X. Returns the fitted scaler"""
+        X = np.asarray(X, dtype=np.float64)
+        self.mean_ = X.mean(axis=0)
+        std = X.std(axis=0)
+        # Constant columns are left unscaled, as in StandardScaler
+        self.scale_ = np.where(std == 0, 1.0, std)
+        return self
+
+    def transform(self, X):
+        """ Returns X standardized with the fitted mean and standard deviation"""
+        return (np.asarray(X, dtype=np.float64) - self.mean_) / self.scale_
+
+    def fit_transform(self, X):
+        """ Fits to X and returns X standardized"""
+        return self.fit(X).transform(X)
+
+def scale_features(train, validate, test, features_to_use, features_to_scale):
+    """Returns split feature dataframes with scaled features (and those features that did not need scaling)"""
     
-    # Segment out features into individual dataframes
-    X_train = train[features_to_use]
-    X_validate = validate[features_to_use]
-    X_test = test[features_to_use]
+    # Non-scaled features come first, followed by the scaled features
+    feature_order = [f for f in features_to_use if f not in features_to_scale] + list(features_to_scale)
 
-    # Segment out target into individual dataframe
+    # Segment out features into individual dataframes
+    X_train = train[feature_order]
+    X_validate = validate[feature_order]
+    X_test = test[feature_order]
+
+    # Will scale features using a standard scaler as sigmas are orders of magnitude different from log_ret
+    scaler = FastStandardScaler()
+
+    # Fit scaler to train. Transform validate and test based on fitted scaler. Scaled values overwrite their columns in a
+    # single copy of each split, non-scaled features are kept as is.
+    X_train_scaled = X_train.copy()
+    X_train_scaled[features_to_scale] = scaler.fit_transform(X_train[features_to_scale].to_numpy())
+    X_validate_scaled = X_validate.copy()
+    X_validate_scaled[features_to_scale] = scaler.transform(X_validate[features_to_scale].to_numpy())
+    X_test_scaled = X_test.copy()
+    X_test_scaled[features_to_scale] = scaler.transform(X_test[features_to_scale].to_numpy())
+
+    # Models are fit on float32 features to halve memory traffic. The scaler statistics are still computed in float64.
+    X_train_scaled = X_train_scaled.astype(np.float32, copy=False)
+    X_validate_scaled = X_validate_scaled.astype(np.float32, copy=False)
+    X_test_scaled = X_test_scaled.astype(np.float32, copy=False)
+
+    return X_train_scaled, X_validate_scaled, X_test_scaled
+
+def get_targets(train, validate, test, target):
+    """Returns split target dataframes. Regression targets are float32 to match the features"""
     y_train = train[[target]]
     y_validate = validate[[target]]
     y_test = test[[target]]
 
-    # Will scale features using StandardScaler as sigmas are orders of magnitude different from log_ret
-    scaler = StandardScaler()
-
-    # Fit scaler to train. Transform validate and test based on fitted scaler. Concatenate to df with non-scaled features.
-    X_train_scaled = pd.concat([X_train.drop(columns = features_to_scale),
-                                pd.DataFrame(data = scaler.fit_transform(X_train[features_to_scale]), 
-                                             columns = features_to_scale, index = X_train.index)], 
-                               axis=1)
-    X_validate_scaled = pd.concat([X_validate.drop(columns = features_to_scale),
-                                pd.DataFrame(data = scaler.transform(X_validate[features_to_scale]), 
-                                             columns = features_to_scale, index = X_validate.index)], 
-                               axis=1)
-    X_test_scaled = pd.concat([X_test.drop(columns = features_to_scale),
-                                pd.DataFrame(data = scaler.transform(X_test[features_to_scale]), 
-                                             columns = features_to_scale, index = X_test.index)], 
-                               axis=1)
-                               
+    if np.issubdtype(y_train[target].dtype, np.floating):
+        y_train = y_train.astype(np.float32, copy=False)
+        y_validate = y_validate.astype(np.float32, copy=False)
+        y_test = y_test.astype(np.float32, copy=False)
+
+    return y_train, y_validate, y_test
+
+def scale_datasets(train, validate, test, target, features_to_use, features_to_scale):
+    """Returns split dataframes with scaled features (and those features that did not need scaling) and the target"""
+    
+    X_train_scaled, X_validate_scaled, X_test_scaled = scale_features(train, validate, test, features_to_use, features_to_scale)
+
+    # Segment out target into individual dataframe
+    y_train, y_validate, y_test = get_targets(train, validate, test, target)
+
     return X_train_scaled, X_validate_scaled, X_test_scaled, y_train, y_validate, y_test
 
-def get_top_features(X_train_scaled, y_train, model, target, n_features):
-    """ Performs recursive feature elimination using the inputted model. Returns the top n_features"""
+def get_top_features(X_train_scaled, y_train, model, target, n_features, rfe_step=1):
+    """ Performs recursive feature elimination using the inputted model. Returns the top n_features.
+    rfe_step is the number of features eliminated per iteration. Values above 1 take fewer fits but can select different features"""
     lm = model
     
-    rfe = RFE(lm, n_features_to_select= n_features)
+    rfe = RFE(lm, n_features_to_select= n_features, step = rfe_step)
 
     rfe.fit(X_train_scaled, y_train[[target]])
 
@@ -119,25 +366,31 @@ def get_top_features(X_train_scaled, y_train, model, target, n_features):
     
     return rfe_feature
 
-def predict_regression(models, train, validate, test, features_to_use, features_to_scale, perform_feature_selection, num_features):
-    """Fits and predicts using inputted list of models. Outputs RMSE results, y_train, and y_validate with individual model results"""
+def get_model_name(model):
+    """ Returns the name used for a model in results: the class name followed by any non-default parameters,
+    e.g. LinearRegression or LogisticRegression(C=0.1), so differently configured models of the same class stay distinct"""
+    return repr(model).split('()')[0]
+
+def predict_regression(models, train, validate, test, features_to_use, features_to_scale, perform_feature_selection, num_features, preprocessed=None):
+    """Fits and predicts using inputted list of models. Outputs RMSE results, y_train, and y_validate with individual model results.
+    preprocessed is an optional output of scale_datasets for this split and target, used instead of scaling again"""
     target = 'fwd_log_ret'
     # Perform scaling
-    X_train_scaled, X_validate_scaled, X_test_scaled, y_train, y_validate, y_test = scale_datasets(train, 
-                                                                                                   validate, 
-                                                                                                   test, 
-                                                                                                   target, 
-                                                                                                   features_to_use, 
-                                                                                                   features_to_scale)
+    if preprocessed is None:
+        preprocessed = scale_datasets(train, validate, test, target, features_to_use, features_to_scale)
+    X_train_scaled, X_validate_scaled, X_test_scaled, y_train, y_validate, y_test = preprocessed
     
     rmses_train = {}
     rmses_validate = {}
+    # Predictions of each model, added to y_train and y_validate once all models are fit
+    train_predictions = {}
+    validate_predictions = {}
     
     # iterate through each model
     for reg_model in models:
         
         # Gets a string name for the model
-        model_name = reg_model.__repr__().split('()')[0]
+        model_name = get_model_name(reg_model)
 
 #         print(model_name)
         
@@ -159,17 +412,17 @@ def predict_regression(models, train, validate, test, features_to_use, features_
         # Fit model to the training data
         reg_model.fit(X_train_scaled_featured, y_train.fwd_log_ret)
         
-        # Predict on train and add results to y_train
-        y_train[model_name] = reg_model.predict(X_train_scaled_featured)
+        # Predict on train
+        train_predictions[model_name] = reg_model.predict(X_train_scaled_featured)
         
         # Get RMSE metric for train
-        rmse_train = mean_squared_error(y_train.fwd_log_ret, y_train[model_name], squared=False)
+        rmse_train = mean_squared_error(y_train.fwd_log_ret, train_predictions[model_name], squared=False)
         
         # Predict on validate
-        y_validate[model_name] = reg_model.predict(X_validate_scaled_featured)
+        validate_predictions[model_name] = reg_model.predict(X_validate_scaled_featured)
 
         # Get RMSE metric for validate
-        rmse_validate = mean_squared_error(y_validate.fwd_log_ret, y_validate[model_name], squared=False)
+        rmse_validate = mean_squared_error(y_validate.fwd_log_ret, validate_predictions[model_name], squared=False)
 
         # Print RMSE results for train and validate
         # print(f"RMSE for {model_name}\nTraining/In-Sample: ", rmse_train, 
@@ -177,38 +430,63 @@ def predict_regression(models, train, validate, test, features_to_use, features_
 
         rmses_validate[model_name] = rmse_validate
         rmses_train[model_name] = rmse_train
+
+    # Add results of all models to y_train and y_validate
+    y_train = y_train.assign(**train_predictions)
+    y_validate = y_validate.assign(**validate_predictions)
         
     return rmses_train, rmses_validate, y_train, y_validate
 
+def _signed_trade_returns(validate, go_long):
+    """Calculates the return of each day's trade on validate (assumes always goes long or short every day), going long
+    where go_long is True and short otherwise. go_long is a (days,) or (days x models) array, or a single bool for the
+    same position every day. Returns close, next day close, return, and pct return. The last day has no next day close,
+    so its returns are null"""
+    close = validate['close'].to_numpy()
+    next_day_close = np.full(len(close), np.nan)
+    next_day_close[:-1] = close[1:]
+    # Close to close change, computed once and signed by the position
+    diff = next_day_close - close
+    sign = np.where(go_long, 1.0, -1.0)
+    if sign.ndim == 2:
+        ret = sign * diff[:, None]
+        pct_ret = ret / close[:, None]
+    else:
+        ret = sign * diff
+        pct_ret = ret / close
+    return close, next_day_close, ret, pct_ret
+
+def _calculate_trade_returns(validate, y_validate, model_names):
+    """Calculates the go long flag, return, and pct return of every model's trades on validate in one vectorized pass.
+    Returns a dataframe of close prices and trade columns per model, the average trade, and the average pct trade of each model"""
+    # Predictions of every model as one (days x models) matrix
+    predictions = y_validate[model_names].to_numpy()
+
+    # Go long where the prediction is positive, otherwise short
+    long_mask = predictions > 0
+    close, next_day_close, ret, pct_ret = _signed_trade_returns(validate, long_mask)
+
+    # Close prices and per model columns, in the same order as adding them one model at a time
+    columns = {"close": close, "next_day_close": next_day_close}
+    for i, mod in enumerate(model_names):
+        columns[mod+"_long"] = long_mask[:, i]
+        columns[mod+"_ret"] = ret[:, i]
+        columns[mod+"_pct_ret"] = pct_ret[:, i]
+    validate_results = pd.DataFrame(columns, index = validate.index)
+
+    return validate_results, np.nanmean(ret, axis=0), np.nanmean(pct_ret, axis=0)
+
 def calculate_regression_results(models, rmses_train, rmses_validate, validate, y_validate):
     """Generates average trade and RMSE dataframe from results of regression modeling"""
     
-    validate_results = pd.DataFrame()
     # Get names of each model
-    model_names = [m.__repr__().split('()')[0] for m in models]
-    # Add close prices to y_validate to enable calculated trade return
-    validate_results["close"] = validate.close
-    validate_results["next_day_close"] = validate.close.shift(-1)
-
-    model_rmse_validate = []
-    model_rmse_train = []
-    model_average_trade_returns = []
-    model_average_pct_trade_returns = []
-
-    # Iterate through each model
-    for mod in model_names:
-        # Create a column saying whether we would go long or not (short)
-        validate_results[mod+"_long"] = y_validate[mod]>0
-        # Calculate the return that day (assumes always goes long or short every day)
-        validate_results[mod+"_ret"] = np.where(validate_results[mod+"_long"], validate_results.next_day_close-validate_results.close, validate_results.close-validate_results.next_day_close)
-        # Calculate the pct return 
-        validate_results[mod+"_pct_ret"] = validate_results[mod+"_ret"]/validate_results.close
-        
-        # print(mod,round(y_validate[mod+"_ret"].mean(),2))
-        model_average_trade_returns.append(validate_results[mod+"_ret"].mean())
-        model_average_pct_trade_returns.append(validate_results[mod+"_pct_ret"].mean())
-        model_rmse_validate.append(rmses_validate[mod])
-        model_rmse_train.append(rmses_train[mod])
+    model_names = [get_model_name(m) for m in models]
+
+    # Calculate the trade returns of every model at once. Close prices are added to enable calculated trade return
+    validate_results, model_average_trade_returns, model_average_pct_trade_returns = _calculate_trade_returns(validate, y_validate, model_names)
+
+    model_rmse_validate = [rmses_validate[mod] for mod in model_names]
+    model_rmse_train = [rmses_train[mod] for mod in model_names]
         
     # Add forward return column to y_validate for baseline comparison
     validate_results['daily_return'] = validate.fwd_ret
@@ -229,15 +507,29 @@ def calculate_regression_results(models, rmses_train, rmses_validate, validate,
 
     return avg_trade_model.sort_values(by='pct_avg_trade',ascending=False), validate_results
 
-def get_rolling_predictions(train, validate, test, model_under_test, target, features_to_use, features_to_scale, perform_feature_selection):
-    """Predicts target for each day in validate based on rolling window of previous n days"""
+def _seeded_clone(model):
+    """Returns an unfitted clone of model. If the model has an unset random_state, it is set to a seed drawn from numpy's
+    global random state, so fits run in parallel workers are still reproducible after np.random.seed"""
+    model = clone(model)
+    params = model.get_params(deep=False)
+    if 'random_state' in params and params['random_state'] is None:
+        model.set_params(random_state=np.random.randint(np.iinfo(np.int32).max))
+    return model
+
+def _fit_predict_window(model_under_test, X_window, y_window, X_next):
+    """Fits model_under_test on a single rolling window. Returns predictions on the window and on the next row"""
+    model_under_test.fit(X_window, y_window)
+    return model_under_test.predict(X_window), model_under_test.predict(X_next)
+
+def get_rolling_predictions(train, validate, test, model_under_test, target, features_to_use, features_to_scale, perform_feature_selection, preprocessed=None, n_jobs=-1):
+    """Predicts target for each day in validate based on rolling window of previous n days.
+    Validate predictions are returned as a flat array with one prediction per validate row.
+    preprocessed is an optional output of scale_datasets for this split and target, used instead of scaling again.
+    n_jobs is the number of workers fitting the windows, pass 1 when already running inside a parallel worker"""
     
-    X_train_scaled, X_validate_scaled, X_test_scaled, y_train_rolled, y_validate, y_test = scale_datasets(train, 
-                                                                                                   validate, 
-                                                                                                   test, 
-                                                                                                   target, 
-                                                                                                   features_to_use, 
-                                                                                                   features_to_scale)            
+    if preprocessed is None:
+        preprocessed = scale_datasets(train, validate, test, target, features_to_use, features_to_scale)
+    X_train_scaled, X_validate_scaled, X_test_scaled, y_train_rolled, y_validate, y_test = preprocessed
     # Whether to use recursive feature elimination
     if perform_feature_selection:
 
@@ -253,66 +545,56 @@ def get_rolling_predictions(train, validate, test, model_under_test, target, fea
         X_validate_scaled_featured_rolled = X_validate_scaled.copy()
         X_test_scaled_featured_rolled = X_test_scaled.copy()
         
-    # Create empty lists to hold predictions. Actuals included here for easier bookkeeping
-    train_rolling_predictions = []
-    train_rolling_actuals = []
-    validate_rolling_predictions = []
-    validate_rolling_actuals = []
-    
-    # Iterate through each row in validate
-    for validate_row in range(len(X_validate_scaled_featured_rolled)):
-        
-        # Print out which row we're on 
-        print(f"{model_under_test} {validate_row+1}/{len(X_validate_scaled_featured_rolled)} Train X range: {X_train_scaled_featured_rolled.index.min().date()} - {X_train_scaled_featured_rolled.index.max().date()}",end="\r")
-        # print(f"\nTrain X range: {X_train_scaled_featured_rolled.index.min().date()} - {X_train_scaled_featured_rolled.index.max().date()}",end="\r")
-
-        # Fit the model to the training data
-        # print(f"Fitting to train, X: {X_train_scaled_featured_rolled.index.min().date()} - {X_train_scaled_featured_rolled.index.max().date()}, y: {y_train_rolled.index.min().date()} - {y_train_rolled.index.max().date()}") 
-        model_under_test.fit(X_train_scaled_featured_rolled, y_train_rolled[target])
-
-        # Predict on Train
-        train_prediction = model_under_test.predict(X_train_scaled_featured_rolled)
-        train_actual = y_train_rolled[target]
-
-        # Append train results to list
-        # print(f"First train prediction {train_prediction[0]} vs actual {train_actual[0]}")
-        train_rolling_predictions.append(train_prediction)
-        train_rolling_actuals.append(train_actual)
-
-        # Predict on validate, only for one row at a time
-        validate_rolling_predictions.append(model_under_test.predict(X_validate_scaled_featured_rolled.iloc[validate_row].array.reshape(1,-1)))
-        validate_rolling_actuals.append(y_validate.iloc[validate_row][target])
-
-        # Remove the first row from X train and y train
-        X_train_scaled_featured_rolled = X_train_scaled_featured_rolled.iloc[1:]
-        y_train_rolled= y_train_rolled.iloc[1:]
-
-        # Add the latest row from X validate and y validate onto train
-        X_train_scaled_featured_rolled = X_train_scaled_featured_rolled.append(X_validate_scaled_featured_rolled.iloc[validate_row])
-        y_train_rolled = y_train_rolled.append(y_validate.iloc[validate_row])
+    # Stack train and validate into contiguous arrays. The rolling window for each validate row is then a view of the
+    # window_size rows preceding it, so no rows are copied as the window moves forward.
+    window_size = len(X_train_scaled_featured_rolled)
+    X_validate_np = X_validate_scaled_featured_rolled.to_numpy(dtype=np.float32)
+    y_validate_np = y_validate[target].to_numpy()
+    X_rolling = np.concatenate([X_train_scaled_featured_rolled.to_numpy(dtype=np.float32), X_validate_np])
+    y_rolling = np.concatenate([y_train_rolled[target].to_numpy(), y_validate_np])
+    rolling_dates = X_train_scaled_featured_rolled.index.append(X_validate_scaled_featured_rolled.index)
+
+    n_validate = len(X_validate_scaled_featured_rolled)
+    print(f"{model_under_test} fitting {n_validate} rolling windows. First train X range: {rolling_dates[0].date()} - {rolling_dates[window_size - 1].date()}")
+
+    # Each validate row is fit independently on its own window, so fit them in parallel. Every task gets its own clone
+    # of the model to avoid sharing fitted state between workers, seeded from this process as workers do not share
+    # its global random state.
+    results = Parallel(n_jobs=n_jobs, prefer="processes")(delayed(_fit_predict_window)(_seeded_clone(model_under_test),
+                                                                                   X_rolling[validate_row : validate_row + window_size],
+                                                                                   y_rolling[validate_row : validate_row + window_size],
+                                                                                   X_validate_np[validate_row : validate_row + 1])
+                                                      for validate_row in range(n_validate))
+
+    # Predictions on each train window and on each validate row. Actuals included here for easier bookkeeping
+    train_rolling_predictions = [train_prediction for train_prediction, _ in results]
+    train_rolling_actuals = [y_rolling[validate_row : validate_row + window_size] for validate_row in range(n_validate)]
+    validate_rolling_predictions = np.concatenate([validate_prediction for _, validate_prediction in results])
+    validate_rolling_actuals = list(y_validate_np)
     
     return train_rolling_predictions, train_rolling_actuals, validate_rolling_predictions, validate_rolling_actuals
 
-def predict_classification(models, train, validate, test, features_to_use, features_to_scale, perform_feature_selection):
-    """Fits and predicts using inputted list of classification models. Outputs Classification results, y_train, and y_validate with individual model results"""
+def predict_classification(models, train, validate, test, features_to_use, features_to_scale, perform_feature_selection, preprocessed=None):
+    """Fits and predicts using inputted list of classification models. Outputs Classification results, y_train, and y_validate with individual model results.
+    preprocessed is an optional output of scale_datasets for this split and target, used instead of scaling again"""
     
     target = 'fwd_close_positive'
     
-    X_train_scaled, X_validate_scaled, X_test_scaled, y_train, y_validate, y_test = scale_datasets(train, 
-                                                                                                   validate, 
-                                                                                                   test, 
-                                                                                                   target, 
-                                                                                                   features_to_use, 
-                                                                                                   features_to_scale)
+    if preprocessed is None:
+        preprocessed = scale_datasets(train, validate, test, target, features_to_use, features_to_scale)
+    X_train_scaled, X_validate_scaled, X_test_scaled, y_train, y_validate, y_test = preprocessed
     
     accuracies_train = {}
     accuracies_validate = {}
+    # Predictions of each model, added to y_train and y_validate once all models are fit
+    train_predictions = {}
+    validate_predictions = {}
     
     # iterate through each model
     for class_model in models:
         
         # Gets a string name for the model
-        model_name = class_model.__repr__().split('()')[0]
+        model_name = get_model_name(class_model)
         
         # Whether to use recursive feature elimination
         if perform_feature_selection:
@@ -332,58 +614,42 @@ def predict_classification(models, train, validate, test, features_to_use, featu
         # Fit model to the training data
         class_model.fit(X_train_scaled_featured, y_train.fwd_close_positive)
         
-        # Predict on train and add results to y_train
-        y_train[model_name] = class_model.predict(X_train_scaled_featured)
+        # Predict on train
+        train_predictions[model_name] = class_model.predict(X_train_scaled_featured)
         
         # Get Accuracy metric for train
-        accuracy_train = accuracy_score(y_train.fwd_close_positive, y_train[model_name])
+        accuracy_train = accuracy_score(y_train.fwd_close_positive, train_predictions[model_name])
         
         # Predict on validate
-        y_validate[model_name] = class_model.predict(X_validate_scaled_featured)
+        validate_predictions[model_name] = class_model.predict(X_validate_scaled_featured)
         
 
         # Get RMSE metric for validate
-        accuracy_validate = accuracy_score(y_validate.fwd_close_positive, y_validate[model_name])
+        accuracy_validate = accuracy_score(y_validate.fwd_close_positive, validate_predictions[model_name])
 
         accuracies_validate[model_name] = accuracy_validate
         accuracies_train[model_name] = accuracy_train
         accuracies_train['baseline'] = y_train[target].mean()
         accuracies_validate['baseline'] = y_validate[target].mean()
+
+    # Add results of all models to y_train and y_validate
+    y_train = y_train.assign(**train_predictions)
+    y_validate = y_validate.assign(**validate_predictions)
         
     return accuracies_train, accuracies_validate, y_train, y_validate
 
 def calculate_classification_results(models, accuracies_train, accuracies_validate, validate, y_validate):
     """Generates average trade and Accuracy dataframe from results of classification modeling"""
-    validate_results = pd.DataFrame()
-    # Get names of each model
-    model_names = [m.__repr__().split('()')[0] for m in models]
-    # Add close prices to y_validate to enable calculated trade return
-    validate_results["close"] = validate.close
-    validate_results["next_day_close"] = validate.close.shift(-1)
-
-    model_accuracy_validate = []
-    model_accuracy_train = []
-    model_average_trade_returns = []
-    model_average_pct_trade_returns = []
-
-    # Iterate through each model
-    for mod in model_names:
-        # Skip baseline model
-        if mod == 'baseline':
-            continue
-        # Create a column saying whether we would go long based on the the model prediction
-        validate_results[mod+"_long"] = y_validate[mod]>0
-        # Calculate the return that day (assumes always goes long or short every day)
-        validate_results[mod+"_ret"] = np.where(validate_results[mod+"_long"], 
-                                          validate_results.next_day_close-validate_results.close, 
-                                          validate_results.close-validate_results.next_day_close)
-        # Calculate the pct return 
-        validate_results[mod+"_pct_ret"] = validate_results[mod+"_ret"]/validate_results.close
-        # print(mod,round(y_validate[mod+"_ret"].mean(),2))
-        model_average_trade_returns.append(validate_results[mod+"_ret"].mean())
-        model_average_pct_trade_returns.append(validate_results[mod+"_pct_ret"].mean())
-        model_accuracy_validate.append(accuracies_validate[mod])
-        model_accuracy_train.append(accuracies_train[mod])
+    # Get names of each model, skipping baseline model
+    model_names = [get_model_name(m) for m in models]
+    model_names = [mod for mod in model_names if mod != 'baseline']
+
+    # Calculate the trade returns of every model at once, going long where the model predicts a positive close.
+    # Close prices are added to enable calculated trade return
+    validate_results, model_average_trade_returns, model_average_pct_trade_returns = _calculate_trade_returns(validate, y_validate, model_names)
+
+    model_accuracy_validate = [accuracies_validate[mod] for mod in model_names]
+    model_accuracy_train = [accuracies_train[mod] for mod in model_names]
         
     # Add forward return column to y_validate for baseline comparison
     validate_results['daily_return'] = validate.fwd_ret
@@ -404,51 +670,80 @@ def calculate_classification_results(models, accuracies_train, accuracies_valida
 
     return avg_trade_model.sort_values(by='pct_avg_trade',ascending=False), validate_results
 
+def _parallel_over_products():
+    """ Whether to process each cryptocurrency in a separate process. Enabled by setting the CF_PARALLEL environment variable to 1"""
+    return os.environ.get("CF_PARALLEL") == "1"
+
+def _conventional_split_product(k, split, reg_models, class_models, features_to_use, features_to_scale):
+    """ Fits and evaluates the regression and classification models on one cryptocurrency's [train, validate, test] split.
+    Returns the regression and classification results on validate and the average trade results for the models"""
+    print(f"Train/validate: {k}")
+    train, validate, test = split
+
+    # Scale features once, shared by the regression and classification models
+    scaled_features = scale_features(train, validate, test, features_to_use, features_to_scale)
+    ### Iterate through regression models, uses existing train, validate, test split
+    # Specify regression models to test. Feature selection using recursive feature elimination is also available.
+
+    # Fits model using train and gets predictions for validate
+    rmses_train, rmses_validate, y_train, y_validate = predict_regression(reg_models, 
+                                                                                train, 
+                                                                                validate, 
+                                                                                test, 
+                                                                                features_to_use, 
+                                                                                features_to_scale,
+                                                                                perform_feature_selection=True,
+                                                                                num_features = 5,
+                                                                                preprocessed = scaled_features + get_targets(train, validate, test, 'fwd_log_ret'))
+    # Consolidates results into dataframe. Outputs average trade information for each model.
+    reg_avg_trade_model_results, reg_v_results =  calculate_regression_results(reg_models, rmses_train, rmses_validate, validate, y_validate)
+
+    # Fits model using train and gets predictions for validate
+    accuracies_train, accuracies_validate, y_train, y_validate = predict_classification(class_models, 
+                                                                                train, 
+                                                                                validate, 
+                                                                                test, 
+                                                                                features_to_use, 
+                                                                                features_to_scale,
+                                                                                perform_feature_selection=False,
+                                                                                preprocessed = scaled_features + get_targets(train, validate, test, 'fwd_close_positive'))
+    # Put results into dataframe
+    class_avg_trade_model_results, class_v_results  =  calculate_classification_results(class_models, accuracies_train, accuracies_validate, validate, y_validate)
+
+    # Add classification results from standard data split
+    avg_trade_model_results = pd.concat([reg_avg_trade_model_results, class_avg_trade_model_results]).sort_values(by='pct_avg_trade',ascending=False)
+
+    return reg_v_results, class_v_results, avg_trade_model_results
+
 def conventional_split(split_data, reg_models, class_models, features_to_use, features_to_scale):
     """ Performs model training and testing for the conventional data split (not single step. 
     Returns results of modeling - dictionaries for classification and regression results on validate and a dataframe
-    of results for all models."""
+    of results for all models.
+    Each cryptocurrency is processed in a separate process when the CF_PARALLEL environment variable is set to 1."""
     # Trading strategy results - dictionary to hold key for each cryptocurrency
     avg_trade_model_results = {}
     # Predictions from validate
     class_validate_results = {}
     reg_validate_results = {}
 
-    for k in split_data.keys():
-        print(f"Train/validate: {k}")
-        train, validate, test = split_data[k]
-        ### Iterate through regression models, uses existing train, validate, test split
-        # Specify regression models to test. Feature selection using recursive feature elimination is also available.
-
-        # Fits model using train and gets predictions for validate
-        rmses_train, rmses_validate, y_train, y_validate = predict_regression(reg_models, 
-                                                                                    train, 
-                                                                                    validate, 
-                                                                                    test, 
-                                                                                    features_to_use, 
-                                                                                    features_to_scale,
-                                                                                    perform_feature_selection=True,
-                                                                                    num_features = 5)
-        # Consolidates results into dataframe. Outputs average trade information for each model.
-        reg_avg_trade_model_results, reg_v_results =  calculate_regression_results(reg_models, rmses_train, rmses_validate, validate, y_validate)
+    keys = list(split_data.keys())
+    if len(keys) > 1 and _parallel_over_products():
+        # Each process gets its own copy of the models so no fitted state is shared
+        with ProcessPoolExecutor() as executor:
+            product_results = list(executor.map(_conventional_split_product,
+                                                keys,
+                                                [split_data[k] for k in keys],
+                                                [[clone(m) for m in reg_models] for k in keys],
+                                                [[clone(m) for m in class_models] for k in keys],
+                                                [features_to_use for k in keys],
+                                                [features_to_scale for k in keys]))
+    else:
+        product_results = [_conventional_split_product(k, split_data[k], reg_models, class_models, features_to_use, features_to_scale) for k in keys]
 
+    for k, (reg_v_results, class_v_results, product_avg_trade_model_results) in zip(keys, product_results):
         reg_validate_results[k] = reg_v_results
-
-        # Fits model using train and gets predictions for validate
-        accuracies_train, accuracies_validate, y_train, y_validate = predict_classification(class_models, 
-                                                                                    train, 
-                                                                                    validate, 
-                                                                                    test, 
-                                                                                    features_to_use, 
-                                                                                    features_to_scale,
-                                                                                    perform_feature_selection=False)
-        # Put results into dataframe
-        class_avg_trade_model_results, class_v_results  =  calculate_classification_results(class_models, accuracies_train, accuracies_validate, validate, y_validate)
-
-        # Add classification results from standard data split
-        avg_trade_model_results[k]= reg_avg_trade_model_results.append(class_avg_trade_model_results).sort_values(by='pct_avg_trade',ascending=False)
-
         class_validate_results[k] = class_v_results
+        avg_trade_model_results[k] = product_avg_trade_model_results
 
     conventional_split_model_results = pd.DataFrame()
     for k in avg_trade_model_results.keys():
@@ -465,63 +760,91 @@ def conventional_split(split_data, reg_models, class_models, features_to_use, fe
     
     return reg_validate_results, class_validate_results, conventional_split_model_results
 
+def _rolling_reg_product(k, split, reg_models, target, features_to_use, features_to_scale, n_jobs=-1):
+    """Performs rolling regression fit/test on one cryptocurrency's [train, validate, test] split. Returns dictionary of results for each model.
+    n_jobs is passed to get_rolling_predictions"""
+    reg_model_results = {}
+    train, validate, test = split
+
+    # Scale once, shared by every model
+    preprocessed = scale_datasets(train, validate, test, target, features_to_use, features_to_scale)
+    for model_under_test in reg_models:
+
+        print("testing",k,model_under_test)
+
+        model_name = get_model_name(model_under_test)
+
+        # Perform rolling predictions
+        train_rolling_predictions, train_rolling_actuals, validate_rolling_predictions, validate_rolling_actuals = get_rolling_predictions(train, 
+                                                                validate, 
+                                                                test, 
+                                                                model_under_test,
+                                                                target, 
+                                                                features_to_use, 
+                                                                features_to_scale,
+                                                                True,
+                                                                preprocessed = preprocessed,
+                                                                n_jobs = n_jobs)
+        # Calculate the mean of all train RMSEs. Every window is the same length so they are stacked into one
+        # (windows x days) array and the RMSE of each window is computed at once
+        train_errors = np.stack(train_rolling_actuals).astype(np.float64) - np.stack(train_rolling_predictions)
+        train_rmse = np.sqrt((train_errors**2).mean(axis=1)).mean()
+
+        # Validate predictions, one per validate row
+        predictions = validate_rolling_predictions
+
+        # Calculate validate RMSE
+        validate_rmse = mean_squared_error(validate_rolling_actuals, predictions, squared=False)
+
+        print(model_name,"avg validate rmse",validate_rmse)
+
+        # Go long or not (short) based on the sign of the predictions value
+        go_long = predictions > 0
+        close, next_day_close, ret, pct_ret = _signed_trade_returns(validate, go_long)
+
+        # Create a dataframe with actual validate log returns, predictions, close prices, next day close prices, and trade returns
+        validate_res = pd.DataFrame({'actual': validate_rolling_actuals,
+                                     'predictions': predictions,
+                                     'close': close,
+                                     'next_day_close': next_day_close,
+                                     'go_long': go_long,
+                                     'ret': ret,
+                                     'pct_ret': pct_ret}, index = validate.index)
+
+        # Store validate results in dictionary
+        reg_model_results[model_name] = validate_res
+        reg_model_results[model_name+"_validate_rmse"] = validate_rmse
+        reg_model_results[model_name+"_train_rmse"] = train_rmse
+
+    return reg_model_results
+
 def rolling_reg_models(split_data, reg_models, target, features_to_use, features_to_scale):
-    """Performs rolling regression fit/test from split_data and for models indicated in reg_models """
+    """Performs rolling regression fit/test from split_data and for models indicated in reg_models.
+    Each cryptocurrency is processed in a separate process when the CF_PARALLEL environment variable is set to 1."""
     # target = 'fwd_log_ret'
     all_product_results = {}
 
     # Specify regression models to test. Feature selection using recursive feature elimination is also available.
     # reg_models = [SVR(kernel='linear',gamma=0.1)]#, LinearRegression(), TweedieRegressor(), LassoLars(), DecisionTreeRegressor()]
 
-    for k in split_data.keys():
-        reg_model_results = {}
-        train, validate, test = split_data[k]
-        for model_under_test in reg_models:
-
-            print("testing",k,model_under_test)
-
-            model_name = model_under_test.__repr__().split('()')[0]
-
-            # Perform rolling predictions
-            train_rolling_predictions, train_rolling_actuals, validate_rolling_predictions, validate_rolling_actuals = get_rolling_predictions(train, 
-                                                                    validate, 
-                                                                    test, 
-                                                                    model_under_test,
-                                                                    target, 
-                                                                    features_to_use, 
-                                                                    features_to_scale,
-                                                                    True)
-            # Calculate the mean of all train RMSEs
-            train_rmse = np.mean([mean_squared_error(train_rolling_actuals[i],train_rolling_predictions[i],squared=False) for i in range(len(train_rolling_actuals))])
-
-            # Calculate validate RMSE
-            validate_rmse = mean_squared_error(validate_rolling_actuals, [v[0] for v in validate_rolling_predictions], squared=False)
-
-            print(model_name,"avg validate rmse",validate_rmse)
-
-            # Create a dataframe with actual validate log returns, predictions, close prices, next day close prices
-            validate_res = pd.DataFrame()
-            validate_res['actual'] = validate_rolling_actuals
-            validate_res['predictions'] = [v[0] for v in validate_rolling_predictions]
-
-            # Set result index to validate's index
-            validate_res.index = validate.index
-
-            # Transfer close values over to results dataframe to allow for return calculation
-            validate_res["close"] = validate.close
-            validate_res["next_day_close"] = validate.close.shift(-1)
-            # Create a column for whether we would go long or not (short) based on the sign of the predictions value
-            validate_res["go_long"] = validate_res['predictions']>0
-            # Calculate the return that day (assumes always goes long or short every day)
-            validate_res["ret"] = np.where(validate_res["go_long"], validate_res.next_day_close-validate_res.close, validate_res.close-validate_res.next_day_close)
-            validate_res["pct_ret"] = validate_res["ret"]/validate_res.close
-
-            # Store validate results in dictionary
-            reg_model_results[model_name] = validate_res
-            reg_model_results[model_name+"_validate_rmse"] = validate_rmse
-            reg_model_results[model_name+"_train_rmse"] = train_rmse
-
-        # Append to all products dictionary 
+    keys = list(split_data.keys())
+    if len(keys) > 1 and _parallel_over_products():
+        # Each process gets its own copy of the models so no fitted state is shared. The rolling windows are fit
+        # sequentially within each process rather than each starting its own pool of workers.
+        with ProcessPoolExecutor() as executor:
+            product_results = list(executor.map(_rolling_reg_product,
+                                                keys,
+                                                [split_data[k] for k in keys],
+                                                [[clone(m) for m in reg_models] for k in keys],
+                                                [target for k in keys],
+                                                [features_to_use for k in keys],
+                                                [features_to_scale for k in keys],
+                                                [1 for k in keys]))
+    else:
+        product_results = [_rolling_reg_product(k, split_data[k], reg_models, target, features_to_use, features_to_scale) for k in keys]
+
+    # Append to all products dictionary 
+    for k, reg_model_results in zip(keys, product_results):
         all_product_results[k] = reg_model_results
         
     return all_product_results
@@ -558,62 +881,76 @@ def consolidate_rolling_reg(all_product_results):
     return reg_model_results_df
 
 
-def rolling_class_models(split_data, class_models, target, features_to_use, features_to_scale):
-    """Performs rolling classification fit/test from split_data and for models indicated in reg_models """
+def _rolling_class_model(k, split, model_under_test, model_name, target, features_to_use, features_to_scale, preprocessed=None):
+    """Performs rolling classification fit/test of one model on one cryptocurrency's [train, validate, test] split.
+    model_name is the name of the model as given, before any random_state was set on it.
+    Returns the model name, dataframe of validate results, validate accuracy, and train accuracy.
+    preprocessed is an optional output of scale_datasets for this split and target, used instead of scaling again"""
+    train, validate, test = split
 
-    class_model_results = {}
-    all_product_class_results = {}
+    train_rolling_predictions, train_rolling_actuals, validate_rolling_predictions, validate_rolling_actuals = get_rolling_predictions(train,validate,test, model_under_test, target, features_to_use, features_to_scale, False, preprocessed = preprocessed, n_jobs = 1)
+    
+    # Calculate the mean of all train accuracies
+    train_accuracy = np.mean([accuracy_score(train_rolling_actuals[i],train_rolling_predictions[i]) for i in range(len(train_rolling_actuals))])
 
-    for k in split_data.keys():
-        train, validate, test = split_data[k]
-        for model_under_test in class_models:
+    # Calculate validate accuracy
+    validate_accuracy = accuracy_score(validate_rolling_actuals, validate_rolling_predictions)
 
-            model_name = model_under_test.__repr__().split('()')[0]
+    print(k, model_name,"validate accuracy",validate_accuracy)
 
-            train_rolling_predictions, train_rolling_actuals, validate_rolling_predictions, validate_rolling_actuals = get_rolling_predictions(train,validate,test, model_under_test, target, features_to_use, features_to_scale, False)
-            
-            # Calculate the mean of all train accuracies
-            train_accuracy = np.mean([accuracy_score(train_rolling_actuals[i],train_rolling_predictions[i]) for i in range(len(train_rolling_actuals))])
+    # Go long or not (short) based on the predictions
+    go_long = validate_rolling_predictions > 0
+    close, next_day_close, ret, pct_ret = _signed_trade_returns(validate, go_long)
 
-            # Calculate validate accuracy
-            validate_accuracy = accuracy_score(validate_rolling_actuals, [v[0] for v in validate_rolling_predictions])
+    # Create a dataframe with actual validate values, predictions, close prices, next day close prices, and trade returns
+    validate_res = pd.DataFrame({'actual': validate_rolling_actuals,
+                                 'predictions': validate_rolling_predictions,
+                                 'close': close,
+                                 'next_day_close': next_day_close,
+                                 'go_long': go_long,
+                                 'ret': ret,
+                                 'pct_ret': pct_ret}, index = validate.index)
 
-            print(k, model_name,"validate accuracy",validate_accuracy)
+    return model_name, validate_res, validate_accuracy, train_accuracy
 
-            # Create a dataframe with actual validate log returns, predictions, close prices, next day close prices
-            validate_res = pd.DataFrame()
-            validate_res['actual'] = validate_rolling_actuals
-            validate_res['predictions'] = [v[0] for v in validate_rolling_predictions]
+def rolling_class_models(split_data, class_models, target, features_to_use, features_to_scale):
+    """Performs rolling classification fit/test from split_data and for models indicated in reg_models """
 
-            validate_res.index = validate.index
+    all_product_class_results = {}
 
-            validate_res["close"] = validate.close
-            validate_res["next_day_close"] = validate.close.shift(-1)
-            # Create a column saying whether we would go long or not (short) based on the 
-            validate_res["go_long"] = validate_res['predictions']>0
-            # Calculate the return that day (assumes goes long or short every day)
-            validate_res["ret"] = np.where(validate_res["go_long"], validate_res.next_day_close-validate_res.close, validate_res.close-validate_res.next_day_close)
-            validate_res["pct_ret"] = validate_res["ret"]/validate_res.close
+    # Every (cryptocurrency, model) pair is independent so fit them in parallel. Each task gets its own clone of the
+    # model to avoid sharing fitted state between workers, seeded from this process as workers do not share its global
+    # random state. The rolling windows of each pair are then fit sequentially within its worker.
+    keys = list(split_data.keys())
+    # Scale each cryptocurrency's split once, shared by all of its models
+    preprocessed = {k: scale_datasets(*split_data[k], target, features_to_use, features_to_scale) for k in keys}
+    model_results = Parallel(n_jobs=-1, backend="loky")(delayed(_rolling_class_model)(k, split_data[k], _seeded_clone(model_under_test), get_model_name(model_under_test), target, features_to_use, features_to_scale, preprocessed[k])
+                                                        for k in keys for model_under_test in class_models)
+
+    for i, k in enumerate(keys):
+        class_model_results = {}
+        train, validate, test = split_data[k]
 
+        # Create baseline dataframe, the same for every model so only built once per cryptocurrency
+        # Just predict most common value, ties go to 0 as with Series.mode
+        baseline_prediction = np.bincount(train['fwd_close_positive'].to_numpy()).argmax()
+        # Where prediction is true, go long. The position is the same every day so it is a single sign
+        go_long = bool(baseline_prediction)
+        close, next_day_close, ret, pct_ret = _signed_trade_returns(validate, go_long)
+        baseline = pd.DataFrame({"close": close,
+                                 "next_day_close": next_day_close,
+                                 "predictions": baseline_prediction,
+                                 "go_long": go_long,
+                                 "ret": ret,
+                                 "pct_ret": pct_ret}, index = validate.index)
+
+        class_model_results["baseline"] = baseline
+
+        # Results of this cryptocurrency's models, in the order of class_models
+        for model_name, validate_res, validate_accuracy, train_accuracy in model_results[i*len(class_models) : (i+1)*len(class_models)]:
             class_model_results[model_name] = validate_res
             class_model_results[model_name+"_validate_accuracy"] = validate_accuracy
             class_model_results[model_name+"_train_accuracy"] = train_accuracy
-
-                # Create baseline dataframe
-            baseline = pd.DataFrame(index = validate.index)
-            baseline["close"] = validate.close
-            baseline["next_day_close"] = validate.close.shift(-1)
-            # Just predict most common value
-            baseline["predictions"] = train.fwd_close_positive.mode()[0]
-            # Where prediction is true, go long
-            baseline["go_long"] = baseline["predictions"]
-            # Calculate the return that day (assumes always goes long or short every day)
-            baseline["ret"] = np.where(baseline["go_long"], baseline.next_day_close-baseline.close, baseline.close-baseline.next_day_close)
-            baseline["pct_ret"] = baseline["ret"]/baseline.close
-
-
-
-            class_model_results["baseline"] = baseline
             
         all_product_class_results[k] = class_model_results
 
@@ -627,30 +964,32 @@ def consolidate_rolling_class(all_product_class_results):
     validate_accuracies = []
     indices = []
     
+    # The last validate day has no next day close so its trade returns are null, hence nanmean
     for k in all_product_class_results.keys():
-        for key in all_product_class_results[k]:
+        for key, entry in all_product_class_results[k].items():
             # print(k, key)
             if '_train_accuracy' in key:
-                train_accuracies.append(all_product_class_results[k][key])
+                train_accuracies.append(entry)
             elif '_validate_accuracy' in key:
-                validate_accuracies.append(all_product_class_results[k][key])
+                validate_accuracies.append(entry)
             elif key == 'baseline':
-                # Calculate baseline accuracy
-                if all_product_class_results[k][key].predictions.mode()[0]: # Get the mode of predictions
-                    # If mode is true (baseline True)
-                    baseline_accuracy = (all_product_class_results[k][key].ret>0).mean()
+                ret = entry['ret'].to_numpy()
+                # Calculate baseline accuracy. The baseline predicts the same value every day
+                if entry['predictions'].iat[0]:
+                    # If prediction is true (baseline True)
+                    baseline_accuracy = (ret>0).mean()
                 else:
-                    # If mode is False (baseline False)
-                    baseline_accuracy = 1-(all_product_class_results[k][key].ret>0).mean()
+                    # If prediction is False (baseline False)
+                    baseline_accuracy = 1-(ret>0).mean()
                     
                 train_accuracies.append(baseline_accuracy)
                 validate_accuracies.append(baseline_accuracy)
-                avg_trades.append(all_product_class_results[k][key].ret.mean())
-                avg_pct_trades.append(all_product_class_results[k][key].pct_ret.mean())
-                indices.append(key+"_single_step")
+                avg_trades.append(np.nanmean(ret))
+                avg_pct_trades.append(np.nanmean(entry['pct_ret'].to_numpy()))
+                indices.append(key+"_"+k+"_single_step")
             else:
-                avg_trades.append(all_product_class_results[k][key].ret.mean())
-                avg_pct_trades.append(all_product_class_results[k][key].pct_ret.mean())
+                avg_trades.append(np.nanmean(entry['ret'].to_numpy()))
+                avg_pct_trades.append(np.nanmean(entry['pct_ret'].to_numpy()))
                 indices.append(key+"_"+k+"_single_step")
 
     # Single step classification results
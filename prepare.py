@@ -1,7 +1,10 @@
 import pandas as pd
 import acquire
 import numpy as np
-import scipy.stats as stats
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Day names in pandas dayofweek order
+DAY_NAMES = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
 
 def prepare_crypto_data(results):
     """ Takes in a dictionary with keys as the symbols of different cryptocurrencies and values as a dataframe of open, high, low, close, and volume prices. Returns dictionary with the data prepared:
@@ -38,13 +41,18 @@ def prepare_crypto_data(results):
             # To save time on subsequent loads this value is set based on prior exploration
             # results[key].loc['2017-04-15','low'] = minute_data['BTC-USD'].low.min()
             print("Corrected btc low data for 2017-04-15")
-            results[key].loc['2017-04-15','low'] = 568.120000
+            results[key].iat[results[key].index.get_loc(pd.Timestamp('2017-04-15')), results[key].columns.get_loc('low')] = 568.120000
         elif key == "ETH_USD":
             print("Corrected eth low data for 2017-06-21")
-            results[key].loc['2017-06-21','low'] = 241.0
-        
+            results[key].iat[results[key].index.get_loc(pd.Timestamp('2017-06-21')), results[key].columns.get_loc('low')] = 241.0
 
-        results[key] = add_features(results[key])
+    # Add features for all cryptocurrencies in one pass over a single stacked dataframe, then split it back out
+    stacked = pd.concat([results[key].assign(symbol=key) for key in results.keys()])
+    stacked = add_features(stacked, group_col='symbol')
+    symbols = stacked['symbol'].to_numpy()
+    # Split by the input keys so a cryptocurrency with no rows left after dropna still gets an (empty) featured dataframe
+    for key in results.keys():
+        results[key] = stacked[symbols == key].drop(columns='symbol')
 
     return results
 
@@ -52,50 +60,111 @@ def prepare_crypto_data(results):
 def get_outlier_thresholds(s, k):
     """ Returns lower and upper thresholds based on IQR multiples """
     k = k
-    iqr = stats.iqr(s)
-    upper = np.quantile(s,0.75)+k*iqr
-    lower = np.quantile(s,0.25)-k*iqr
+    # Quartiles linearly interpolated as in np.quantile. Only the order statistics either side of each quartile are
+    # needed, so the values are partitioned around them in linear time instead of fully sorted
+    values = np.asarray(s, dtype=float)
+    position = np.array([0.25, 0.75])*(len(values)-1)
+    below = np.floor(position).astype(int)
+    above = np.ceil(position).astype(int)
+    values = np.partition(values, np.unique(np.concatenate([below, above])))
+    q1, q3 = values[below] + (values[above]-values[below])*(position-below)
+    iqr = q3-q1
+    upper = q3+k*iqr
+    lower = q1-k*iqr
     
     return lower, upper
 
-def add_features(df):
-    """ Adds target and additional features to dataframe. Returns dataframe with additional features """
+def add_features(df, group_col=None):
+    """ Adds target and additional features to dataframe. Returns dataframe with additional features.
+    group_col optionally names a column identifying separate series (e.g. cryptocurrencies) stacked contiguously in df.
+    Forward and lagged values are not carried across series """
+    # New columns are collected here and joined to the dataframe in one concat at the end
+    new_cols = {}
+
+    # Whether each day belongs to the same series as the day before it and as the day a week before it
+    if group_col is None:
+        same_as_prior_day = np.ones(max(len(df)-1, 0), dtype=bool)
+        same_as_prior_week = np.ones(max(len(df)-7, 0), dtype=bool)
+    else:
+        group = df[group_col].to_numpy()
+        same_as_prior_day = group[1:] == group[:-1]
+        same_as_prior_week = group[7:] == group[:-7]
+
+    # Log of close is computed once and shared by the forward log return target and the lagged log return features
+    log_close = np.log(df['close'].to_numpy())
+
     ###### TARGETS ######
-    # forward 1 day log returns
-    df["fwd_log_ret"] = np.log(df.close.shift(-1)) - np.log(df.close)
+    # forward 1 day log returns, null for the last day
+    fwd_log_ret = np.full(len(df), np.nan)
+    fwd_log_ret[:-1] = np.where(same_as_prior_day, log_close[1:] - log_close[:-1], np.nan)
+    new_cols["fwd_log_ret"] = fwd_log_ret
+    # The close to next day close change, null for the last day. Forward returns, forward pct change and today's pct
+    # change are all derived from this one difference
+    close = df['close'].to_numpy()
+    close_diff = np.full(len(df), np.nan)
+    close_diff[:-1] = np.where(same_as_prior_day, close[1:] - close[:-1], np.nan)
     # forward standard returns
-    df["fwd_ret"] = df.close.shift(-1) - df.close
+    new_cols["fwd_ret"] = close_diff
     # forward pct change
-    df["fwd_pct_chg"] = df.close.pct_change(1).shift(-1)
-    # binary positive vs negative next day return
-    df["fwd_close_positive"] = df.fwd_ret>0
+    fwd_pct_chg = close_diff/close
+    new_cols["fwd_pct_chg"] = fwd_pct_chg
+    # binary positive vs negative next day return, as int8 1/0 so classifiers take it without conversion
+    new_cols["fwd_close_positive"] = (close_diff>0).astype(np.int8)
     
     ###### FEATURES ######
-    # Pct change from yesterday
-    df["pct_chg"] = df.close.pct_change()
-
-    # Calculate lagged log returns 
-    for i in range(1,8):
-        df[f'log_ret_lag_{i}'] = np.log(df.close) - np.log(df.close.shift(i))
+    # Pct change from yesterday, which is yesterday's forward pct change
+    pct_chg = np.full(len(df), np.nan)
+    pct_chg[1:] = fwd_pct_chg[:-1]
+    new_cols["pct_chg"] = pct_chg
+
+    # Calculate lagged log returns from the log of close. Each row of the strided (days, 8) window view holds the
+    # log close of a day and the 7 days before it, so all lags come from one vectorized expression. The first 7 days
+    # are left null as they do not have a full week of history, so all lags are null with less than 8 days.
+    lags = np.arange(1,8)
+    log_ret_lags = np.full((len(df), 7), np.nan)
+    if len(df) >= 8:
+        log_close_windows = sliding_window_view(log_close, 8)
+        log_ret_lags[7:] = np.where(same_as_prior_week[:, None], log_close_windows[:, [-1]] - log_close_windows[:, 7 - lags], np.nan)
+    new_cols.update(zip([f'log_ret_lag_{i}' for i in lags], log_ret_lags.T))
         
     # Volatility:
-    # relative price range: RR
-        
-    df["RR"] = 2*(df.high.shift(1)-df.low.shift(1))/(df.high.shift(1)+df.low.shift(1))
+    # relative price range: RR, of the day before
+    high = df['high'].to_numpy()
+    low = df['low'].to_numpy()
+    RR = np.full(len(df), np.nan)
+    RR[1:] = np.where(same_as_prior_day, 2*(high[:-1]-low[:-1])/(high[:-1]+low[:-1]), np.nan)
+    new_cols["RR"] = RR
     
     # range volatility estimator of Parkinson: sigma  - lags 1-7
-    for i in range(1,8):
-        df[f'sigma_lag_{i}'] = ((np.log(df.high.shift(i)/df.low.shift(i))**2)/(4*np.log(2)))**0.5
+    # sqrt(log(high/low)**2 / (4*log(2))) is computed once for each day and then lagged
+    log_high_low = np.log(high) - np.log(low)
+    sigma = np.abs(log_high_low)/(2*np.sqrt(np.log(2)))
+    sigma_lags = np.full((len(df), 7), np.nan)
+    if len(df) >= 8:
+        sigma_windows = sliding_window_view(sigma, 8)
+        sigma_lags[7:] = np.where(same_as_prior_week[:, None], sigma_windows[:, 7 - lags], np.nan)
+    new_cols.update(zip([f'sigma_lag_{i}' for i in lags], sigma_lags.T))
     
     # Day of the week shown to be significant from literature
-    df["day_name"] = df.index.day_name()
-    
-    # Dummy variable for day name
-    df = pd.get_dummies(df, columns=['day_name'])
+    # Dummy variable for day name, one-hot encoded directly from the integer day of the week (Monday = 0)
+    day_of_week = df.index.dayofweek.to_numpy()
+    day_dummies = np.zeros((len(df), 7), dtype=np.uint8)
+    day_dummies[np.arange(len(df)), day_of_week] = 1
+    # Columns in alphabetical order, as created by pd.get_dummies. Values are 1/0 uint8 rather than the bool that
+    # recent versions of pd.get_dummies return
+    day_order = np.argsort(DAY_NAMES)
+    new_cols.update(zip([f'day_name_{DAY_NAMES[i]}' for i in day_order], day_dummies[:, day_order].T))
+
+    df = pd.concat([df, pd.DataFrame(new_cols, index=df.index)], axis=1)
         
     # Drop any remaining nulls (created due to lagged values)
     df = df.dropna()
 
+    # Downcast the engineered model features to float32 to halve memory traffic in the model fits. Prices and
+    # targets stay float64 as they are used for the return calculations.
+    engineered = [f'log_ret_lag_{i}' for i in lags] + ['RR'] + [f'sigma_lag_{i}' for i in lags]
+    df = df.astype(dict.fromkeys(engineered, np.float32))
+
     return df
 
 def split_datasets(data, train_length, validate_length):